@@ -0,0 +1,32 @@
+""" Measure the import time of flagmap, and check that heavy modules are only loaded when needed """
+
+import subprocess
+import sys
+#sys.path.insert(0, '..')
+
+HEAVY_MODULES = ['cairocffi', 'cairosvg', 'cairopath', 'shapely', 'rdp', 'numpy', 'concurrent.futures']
+RUNS = 5
+
+def run(code):
+	# Fresh interpreter for each measurement, so nothing is cached in sys.modules
+	return subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+
+ok = True
+for module in ['flagmap', 'flagmap.download_flags', 'flagmap.resize_flags']:
+	code = f'''
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))
+'''
+	times = []
+	for i in range(RUNS):
+		duration, loaded = run(code).split('\n')[:2]
+		times.append(float(duration))
+	print(f'import {module}: {1000*min(times):.1f} ms (best of {RUNS})')
+	if loaded:
+		print(f'  Loaded on import: {loaded}')
+		ok = False
+
+sys.exit(0 if ok else 1)
@@ -0,0 +1,45 @@
+""" Check that the alternative rendering modes give the same pixels as a normal draw """
+
+import sys
+#sys.path.insert(0, '..')
+import cairocffi as cairo
+import numpy as np
+
+import flagmap
+
+def read_pixels(path):
+	surface = cairo.ImageSurface.create_from_png(path)
+	width, height, stride = surface.get_width(), surface.get_height(), surface.get_stride()
+	pixels = np.frombuffer(surface.get_data(), dtype=np.uint8).reshape(height, stride)[:, :4*width].copy()
+	if surface.get_format() == cairo.FORMAT_RGB24:
+		# Opaque image; the alpha byte is unused
+		pixels.reshape(height, width, 4)[..., 3 if sys.byteorder == 'little' else 0] = 255
+	return pixels
+
+def compare(path1, path2):
+	same = np.array_equal(read_pixels(path1), read_pixels(path2))
+	print(('Same: ' if same else 'DIFFERENT: ') + path1 + ', ' + path2)
+	return same
+
+mapOptions = {'height': 1200, 'stroke_width': 1.5}
+map = flagmap.FlagMap('US_map.svg', mapOptions, print_progress=False)
+map.add_folder('US')
+ok = True
+
+# Banded PNG export (uses flags from US_download.py)
+map.draw('check_full.png')
+map.draw('check_bands.png', band_height=100)
+ok &= compare('check_full.png', 'check_bands.png')
+
+# Frame sequence: after the first frame, only the regions that change are redrawn
+files = {id: flag.file_path for id, flag in map.flags.items()}
+timeline = [{}, {'CO': files['WY'], 'WY': files['CO']}, {'NV': None, 'UT': files['AZ']}]
+map.draw_sequence(timeline, 'check_frame{}.png')
+last_frame = {id: file for id, file in files.items() if id != 'NV'}
+last_frame.update({'CO': files['WY'], 'WY': files['CO'], 'UT': files['AZ']})
+full_map = flagmap.FlagMap('US_map.svg', mapOptions, print_progress=False)
+full_map.add_flags(last_frame)
+full_map.draw('check_frame_full.png')
+ok &= compare('check_frame2.png', 'check_frame_full.png')
+
+sys.exit(0 if ok else 1)
@@ -1,25 +1,25 @@
+import contextlib
 import glob
 import math
 import os
 import re
-import traceback
 import typing as ty
 import xml.etree.ElementTree as ET
 
-import cairocffi as cairo
-from cairosvg.parser import Tree as csvg_Tree
-from cairosvg.surface import SVGSurface as csvg_Surface
-try: # shapely 1.7+
-	from shapely.ops import polylabel
-except ImportError: # shapely 1.6
-	from shapely.algorithms.polylabel import polylabel
-from shapely.geometry import Polygon
-import rdp
+from . import labels, separate
+from .index import RegionIndex
 
-import cairopath
-from . import separate
+# Cairo, CairoSVG, rdp and shapely are imported where they're first needed, so that the
+# helper modules (download_flags, resize_flags) can be used without the native libraries
+if ty.TYPE_CHECKING:
+	import cairopath
 
 xmlns = '{http://www.w3.org/2000/svg}'
+MITER_LIMIT = 10 # Cairo's default
+
+def _stroke_reach(width:float) -> float:
+	# How far a stroke can extend past its path, at mitred corners
+	return width*MITER_LIMIT/2
 
 def _read_map(map_path:str) -> ty.Tuple[ET.Element, float, float]:
 	map_svg = ET.parse(map_path)
@@ -30,6 +30,17 @@ def _read_map(map_path:str) -> ty.Tuple[ET.Element, float, float]:
 		raise Exception(f'couldn\'t parse intrinsic size: {root.attrib["width"]} × {root.attrib["height"]}')
 	return (root, float(width[1]), float(height[1]))
 
+def _build_index(map:ET.Element, canvas:'cairopath.Canvas', scale:float = 1) -> RegionIndex:
+	regions = []
+	for child in map.iter(xmlns + 'path'):
+		id = child.attrib['id'] if 'id' in child.attrib else None
+		if id:
+			border = Border(id, child.attrib['d'])
+			canvas.context.new_path() # reset current point
+			border.parse(canvas)
+			regions.append((id, border.polygons()))
+	return RegionIndex(regions, scale=scale)
+
 class FlagMap:
 	map_options = {
 		'height': None,
@@ -44,7 +55,8 @@ class FlagMap:
 		'small_flag_threshold': None,
 		'small_flag_separate': True,
 		'small_flag_spacing': None,
-		'small_flag_position_lerp': 0.5
+		'small_flag_position_lerp': 0.5,
+		'processes': None
 	}
 
 	def __init__(self, map_path:str, options:dict = {}, *, print_progress:bool = True):
@@ -52,6 +64,8 @@ class FlagMap:
 		self.print_progress = print_progress
 		self.flags = {}
 		self.small_flags = {}
+		self._index = None
+		self._poles = {}
 		self.map_options = {key: options.get(key, val) for key,val in FlagMap.map_options.items()}
 		if self.print_progress:
 			for key in options.keys():
@@ -70,7 +84,7 @@ class FlagMap:
 		if self.map_options['small_flag_spacing'] is None:
 			self.map_options['small_flag_spacing'] = self.map_options['small_flag_size']/5
 
-	def draw(self, output_path:str):
+	def draw(self, output_path:str, *, band_height:ty.Optional[int] = None):
 		scale = self.map_options['height']/self.map_height
 		width = round(scale*self.map_width)
 		height = round(scale*self.map_height)
@@ -80,6 +94,18 @@ class FlagMap:
 			raise ValueError('unsupported output format: ' + ext)
 
 		surface_type = ext[1:]
+		if band_height is not None:
+			if surface_type != 'png':
+				raise ValueError('band_height is only supported for PNG output')
+			if band_height <= 0:
+				raise ValueError(f'band_height must be positive: {band_height}')
+
+		import cairopath
+
+		if band_height:
+			self._draw_bands(output_path, width, height, scale, band_height)
+			return
+
 		canvas = cairopath.Canvas(
 			width, height, bgcolor=self.map_options['background_color'],
 			surfacetype=surface_type, filename=output_path
@@ -87,94 +113,390 @@ class FlagMap:
 		canvas.scale(scale)
 
 		try:
-			small_flags_to_draw = []
-			for child in self.map.iter(xmlns + 'path'):
-				id = child.attrib['id'] if 'id' in child.attrib else None
-				border = Border(id, child.attrib['d'], _print_progress=self.print_progress)
-				border.parse(canvas) # draws the border for the following fill/stroke calls
-				if id and id in self.flags:
-					flag = self.flags[id]
-
-					make_small = flag.flag_options['small_flag'] or \
-					             (id not in self.small_flags and self.map_options['small_flag_threshold'] and
-					              border.width*border.height < self.map_options['small_flag_threshold']**2)
-					if make_small:
-						canvas.fill(self.map_options['map_color'], keep=True) \
-						      .stroke(self.map_options['stroke_color'], width=self.map_options['stroke_width']/scale)
-						center_x, center_y = border.get_center(self.map_options['small_flag_position_lerp'])
-						small_flags_to_draw.append({'flag': flag, 'x': center_x, 'y': center_y})
-						if id in self.small_flags: # flag_options['small_flag'] overrides self.small_flags
-							continue
-					else:
-						flag.read()
-						scale_x, scale_y = border.width/flag.width, border.height/flag.height
-						x, y = border.min_x, border.min_y
-						if self.map_options['preserve_aspect_ratio'] and scale_x != scale_y:
-							if scale_x > scale_y:
-								scaley = scale_x
-								y -= (scale_y*flag.height - border.height)*flag.flag_options['key_point'][1]
-							else:
-								scale_x = scale_y
-								x -= (scale_x*flag.width - border.width)*flag.flag_options['key_point'][0]
-						with canvas.clip(): # uses last drawing (border)
-							flag.draw(canvas, x, y, scale_x, scale_y, small=False)
-						border.draw(canvas)
-						canvas.stroke(self.map_options['stroke_color'], width=self.map_options['stroke_width']/scale)
-
-				elif id: # no flag, or flag from self.small_flags
-					canvas.fill(self.map_options['map_color'], keep=True) \
-					      .stroke(self.map_options['stroke_color'], width=self.map_options['stroke_width']/scale)
-				else: # no id; just draw stroke
-					canvas.stroke(self.map_options['stroke_color'], width=self.map_options['stroke_width']/scale)
-
-				if id in self.small_flags:
-					center_x, center_y = border.get_center(self.map_options['small_flag_position_lerp'])
-					small_flags_to_draw.append({'flag': self.small_flags[id], 'x': center_x, 'y': center_y})
-
-
-			if len(small_flags_to_draw) > 0:
-				if self.map_options['small_flag_separate']:
-					rects = []
-					sep = self.map_options['small_flag_spacing']
-					for arr in small_flags_to_draw:
-						flag = arr['flag']
-						flag.read()
-						flag.scale = flag.flag_options['small_flag_size']/math.sqrt(flag.width*flag.height)
-						arr['width'], arr['height'] = flag.scale*flag.width, flag.scale*flag.height
-						rw, rh = arr['width'] + sep, arr['height'] + sep
-						rx, ry = arr['x'] - rw/2, arr['y'] - rh/2
-						rects.append(separate.Rectangle(rx, ry, rw, rh))
-
-					if self.print_progress:
-						print('Separating')
-					stepper = separate.Separation(rects)
-					while separate.Rectangle.has_overlaps(stepper.rectangles):
-						stepper.step()
-					if self.print_progress:
-						movement = separate.Rectangle.total_movement(stepper.rectangles)
-						print(f'Total movement: {movement:g} px')
-
-					for i, arr in enumerate(small_flags_to_draw):
-						flag = arr['flag']
-						if self.print_progress and len(small_flags_to_draw) > 0:
-							print('Drawing ' + os.path.basename(flag.file_path))
-						flag.draw(canvas, rects[i].midx - arr['width']/2, rects[i].midy - arr['height']/2,
-						          flag.scale, small=True)
-
-				else:
-					for arr in small_flags_to_draw:
-						flag = arr['flag']
-						flag.read()
-						flag.scale = flag.flag_options['small_flag_size']/math.sqrt(flag.width*flag.height)
-						x, y = arr['x'] - flag.scale*flag.width/2, arr['y'] - flag.scale*flag.height/2
-						flag.draw(canvas, x, y, flag.scale, small=True)
-
+			self._render(canvas, scale)
 		finally:
 			if surface_type == 'png':
 				canvas.export(surface_type, output_path)
 			else:
 				canvas.surface.finish()
 
+	def draw_sequence(self, timeline:ty.Sequence[ty.Mapping[str, ty.Optional[str]]],
+	                  output_pattern:str = 'frame{:04d}.png', flag_options:dict = {}, *,
+	                  pipe:ty.Optional[ty.Sequence[str]] = None):
+		# Each timeline entry maps region IDs to a new flag file (or None to remove the flag);
+		# other regions keep their flag from the previous frame, starting from self.flags
+		frames = []
+		current = {id: flag.file_path for id, flag in self.flags.items()}
+		for changes in timeline:
+			current = dict(current)
+			for id, file in changes.items():
+				if file is None:
+					current.pop(id, None)
+				else:
+					current[id] = file
+			frames.append(current)
+		if not frames:
+			return
+
+		import concurrent.futures
+		import subprocess
+		import tempfile
+
+		# Split the frames into one consecutive run per process; each run starts with a full
+		# render and then only updates the regions that change
+		processes = min(self.map_options['processes'] or 1, len(frames))
+		run_length = math.ceil(len(frames)/processes)
+		runs = [range(i, min(i + run_length, len(frames))) for i in range(0, len(frames), run_length)]
+		index = self.get_index() # build once, before the map is copied to worker processes
+		if processes > 1:
+			# Likewise for small flag positions, so the runs don't each calculate them
+			lerp = self.map_options['small_flag_position_lerp']
+			ids = self._small_flag_candidates(frames, flag_options, index)
+			if lerp > 0 and ids:
+				polys = {id: polys for id, polys in zip(index.ids, index.polygons) if id in ids}
+				self._find_poles(polys, index.scale, self.map_options['processes'])
+
+		encoder = None
+		encoder_stopped = False
+		def close_encoder():
+			nonlocal encoder_stopped
+			try:
+				encoder.stdin.close()
+			except BrokenPipeError:
+				encoder_stopped = True
+			encoder.wait()
+
+		with contextlib.ExitStack() as stack:
+			if pipe:
+				# Frames are written to a temporary folder, then passed to the encoder in order
+				folder = stack.enter_context(tempfile.TemporaryDirectory())
+				output_pattern = os.path.join(folder, 'frame{:06d}.png')
+				encoder = subprocess.Popen(pipe, stdin=subprocess.PIPE)
+				stack.callback(close_encoder)
+			paths = [output_pattern.format(i) for i in range(len(frames))]
+
+			if processes > 1:
+				executor = concurrent.futures.ProcessPoolExecutor(processes)
+				stack.callback(executor.shutdown, cancel_futures=True)
+				futures = [executor.submit(self._render_frames, [frames[i] for i in run],
+				                           [paths[i] for i in run], flag_options) for run in runs]
+				finished = (path for future in futures for path in future.result())
+			else:
+				finished = self._iter_frames(frames, paths, flag_options)
+
+			for path in finished:
+				if encoder:
+					try:
+						with open(path, 'rb') as f:
+							encoder.stdin.write(f.read())
+						encoder.stdin.flush()
+					except BrokenPipeError: # encoder exited early
+						encoder_stopped = True
+						break
+					os.remove(path)
+
+		if encoder and encoder.returncode:
+			raise subprocess.CalledProcessError(encoder.returncode, pipe)
+		if encoder_stopped:
+			raise BrokenPipeError(f'encoder stopped reading frames before the end of the sequence: {pipe}')
+
+	def _region_areas(self, index:RegionIndex) -> ty.Dict[str, float]:
+		# Bounding box areas, as used for small_flag_threshold
+		return {id: (b[2] - b[0])*(b[3] - b[1]) for id, b in zip(index.ids, index.bboxes)}
+
+	def _small_flag_candidates(self, frames:ty.List[ty.Dict[str, str]], flag_options:dict,
+	                           index:RegionIndex) -> ty.Set[str]:
+		# IDs of regions that may be drawn as small flags in any of the frames
+		areas = self._region_areas(index)
+		threshold = self.map_options['small_flag_threshold']
+		default_small = flag_options.get('small_flag', self.map_options['small_flag'])
+		ids = set(self.small_flags)
+		for frame in frames:
+			for id, file in frame.items():
+				flag = self.flags.get(id)
+				small = flag.flag_options['small_flag'] if flag and flag.file_path == file else default_small
+				if small or (threshold and areas.get(id, 0) < threshold**2):
+					ids.add(id)
+		return ids
+
+	def _render_frames(self, frames:ty.List[ty.Dict[str, str]], paths:ty.List[str],
+	                   flag_options:dict) -> ty.List[str]:
+		# Runs in a worker process, on a copy of the map; don't start more processes from here
+		self.map_options = dict(self.map_options, processes=None)
+		return list(self._iter_frames(frames, paths, flag_options))
+
+	def _iter_frames(self, frames:ty.List[ty.Dict[str, str]], paths:ty.List[str],
+	                 flag_options:dict) -> ty.Iterator[str]:
+		import cairopath
+
+		scale = self.map_options['height']/self.map_height
+		width = round(scale*self.map_width)
+		height = round(scale*self.map_height)
+		index = self.get_index()
+		borders = [(child.attrib['id'] if 'id' in child.attrib else None, child.attrib['d'])
+		           for child in self.map.iter(xmlns + 'path')]
+		flag_cache = {(id, flag.file_path): flag for id, flag in self.flags.items()}
+
+		indexed = set(index.ids)
+		areas = self._region_areas(index)
+		threshold = self.map_options['small_flag_threshold']
+
+		def has_small(flags):
+			# Same test as _draw_region
+			return any(flag.flag_options['small_flag'] or
+			           (id not in self.small_flags and threshold and areas.get(id, 0) < threshold**2)
+			           for id, flag in flags.items())
+
+		canvas = None
+		previous = None
+		previous_flags = {}
+		for frame, path in zip(frames, paths):
+			flags = {}
+			for id, file in frame.items():
+				if (id, file) not in flag_cache:
+					flag_cache[(id, file)] = Flag(id, file, flag_options, _map_options=self.map_options,
+					                              _print_progress=self.print_progress)
+				flags[id] = flag_cache[(id, file)]
+
+			if self.print_progress:
+				print('Drawing ' + os.path.basename(path))
+			# Small flags may move when any region changes, so frames that have them
+			# (or follow a frame that had them) are drawn in full
+			if canvas is None or self.small_flags or has_small(flags) or has_small(previous_flags):
+				canvas = cairopath.Canvas(width, height, bgcolor=self.map_options['background_color'])
+				canvas.scale(scale)
+				self._render(canvas, scale, flags=flags)
+			else:
+				changed = {id for id in frame.keys() | previous.keys() if frame.get(id) != previous.get(id)}
+				for id in changed:
+					self._redraw_area(canvas, scale, id, borders, index, indexed, flags)
+
+			# Written directly from the surface, which stays in use for the next frame
+			canvas.surface.write_to_png(path)
+			previous, previous_flags = frame, flags
+			yield path
+
+	def _redraw_area(self, canvas:'cairopath.Canvas', scale:float, id:str,
+	                 borders:ty.List[ty.Tuple[ty.Optional[str], str]], index:RegionIndex,
+	                 indexed:ty.Set[str], flags:ty.Dict[str, 'Flag']):
+		# Repaint the pixels around one region from scratch, redrawing every path that overlaps them
+		# in the original order, so the result is the same as a full render
+		import cairocffi as cairo
+
+		d = next((d for border_id, d in borders if border_id == id), None)
+		if d is None:
+			return
+		border = Border(id, d, _print_progress=self.print_progress)
+		canvas.context.new_path()
+		border.parse(canvas)
+		canvas.context.new_path()
+
+		# Area in output pixels, including the stroke (with mitred corners) and its antialiasing
+		pad = _stroke_reach(self.map_options['stroke_width']) + 1
+		x0 = max(0, math.floor(border.min_x*scale - pad))
+		y0 = max(0, math.floor(border.min_y*scale - pad))
+		x1 = math.ceil(border.max_x*scale + pad)
+		y1 = math.ceil(border.max_y*scale + pad)
+		hits = set(index.regions_in(x0 - pad, y0 - pad, x1 - x0 + 2*pad, y1 - y0 + 2*pad))
+
+		context = canvas.context
+		context.save()
+		try:
+			# Pixel-aligned clip, so pixels are either fully redrawn or left alone
+			matrix = context.get_matrix()
+			context.identity_matrix()
+			context.rectangle(x0, y0, x1 - x0, y1 - y0)
+			context.set_matrix(matrix)
+			context.clip()
+
+			context.save()
+			context.set_operator(cairo.OPERATOR_CLEAR)
+			context.paint()
+			context.restore()
+			if self.map_options['background_color']:
+				with canvas.translate(x0/scale - 1, y0/scale - 1):
+					canvas.rect((x1 - x0)/scale + 2, (y1 - y0)/scale + 2).fill(self.map_options['background_color'])
+
+			# Paths that aren't in the index (no ID, or no area) can't be looked up, so redraw them all
+			for border_id, d in borders:
+				if border_id is None or border_id not in indexed or border_id in hits:
+					border = Border(border_id, d, _print_progress=self.print_progress)
+					context.new_path()
+					border.parse(canvas)
+					self._draw_region(canvas, border, scale, [], flags)
+		finally:
+			context.restore()
+
+	def _draw_bands(self, output_path:str, width:int, height:int, scale:float, band_height:int):
+		import cairopath
+		from . import png
+
+		# Render the map once per band, shifted up so the band is at the top of a small surface.
+		# Small flag positions are only calculated for the first band, and reused for the others,
+		# which also skip drawing anything outside the band.
+		small_flag_layout = None
+		with png.PNGWriter(output_path, width, height) as writer:
+			for top in range(0, height, band_height):
+				canvas = cairopath.Canvas(width, min(band_height, height - top),
+				                          bgcolor=self.map_options['background_color'])
+				canvas.context.translate(0, -top)
+				canvas.scale(scale)
+				band = (top, top + band_height)
+				small_flag_layout = self._render(canvas, scale, small_flag_layout, band)
+				writer.write_surface(canvas.surface)
+				canvas.surface.finish()
+
+	def _render(self, canvas:'cairopath.Canvas', scale:float,
+	            small_flag_layout:ty.Optional[ty.List[tuple]] = None,
+	            band:ty.Optional[ty.Tuple[int, int]] = None,
+	            flags:ty.Optional[ty.Dict[str, 'Flag']] = None) -> ty.List[tuple]:
+		# Returns the small flags as (flag, x, y, scale) tuples, which can be passed back in
+		# to draw them in the same places without recalculating. If a layout is given, paths
+		# and flags outside `band` (a range of output rows) are skipped. `flags` replaces self.flags.
+		if flags is None:
+			flags = self.flags
+		skip = band is not None and small_flag_layout is not None
+		pad = _stroke_reach(self.map_options['stroke_width']) + 1
+		small_flags_to_draw = []
+		for child in self.map.iter(xmlns + 'path'):
+			id = child.attrib['id'] if 'id' in child.attrib else None
+			border = Border(id, child.attrib['d'], _print_progress=self.print_progress)
+			border.parse(canvas) # draws the border for the following fill/stroke calls
+			if skip and (border.max_y*scale + pad < band[0] or border.min_y*scale - pad > band[1]):
+				canvas.context.new_path()
+				continue
+			self._draw_region(canvas, border, scale, small_flags_to_draw, flags)
+
+		if small_flag_layout is None:
+			small_flag_layout = self._layout_small_flags(small_flags_to_draw, scale)
+		for flag, x, y, flag_scale in small_flag_layout:
+			if skip:
+				flag_pad = _stroke_reach(2*flag.flag_options['stroke_width'])*scale + 1
+				if (y + flag.height*flag_scale)*scale + flag_pad < band[0] or y*scale - flag_pad > band[1]:
+					continue
+			if self.print_progress:
+				print('Drawing ' + os.path.basename(flag.file_path))
+			flag.draw(canvas, x, y, flag_scale, small=True)
+
+		return small_flag_layout
+
+	def _draw_region(self, canvas:'cairopath.Canvas', border:'Border', scale:float,
+	                 small_flags_to_draw:ty.List[dict], flags:ty.Dict[str, 'Flag']):
+		# Fill and stroke a parsed border, or queue it for a small flag
+		id = border.id
+		if id and id in flags:
+			flag = flags[id]
+
+			make_small = flag.flag_options['small_flag'] or \
+			             (id not in self.small_flags and self.map_options['small_flag_threshold'] and
+			              border.width*border.height < self.map_options['small_flag_threshold']**2)
+			if make_small:
+				canvas.fill(self.map_options['map_color'], keep=True) \
+				      .stroke(self.map_options['stroke_color'], width=self.map_options['stroke_width']/scale)
+				small_flags_to_draw.append({'flag': flag, 'border': border})
+				if id in self.small_flags: # flag_options['small_flag'] overrides self.small_flags
+					return
+			else:
+				flag.read()
+				scale_x, scale_y = border.width/flag.width, border.height/flag.height
+				x, y = border.min_x, border.min_y
+				if self.map_options['preserve_aspect_ratio'] and scale_x != scale_y:
+					if scale_x > scale_y:
+						scaley = scale_x
+						y -= (scale_y*flag.height - border.height)*flag.flag_options['key_point'][1]
+					else:
+						scale_x = scale_y
+						x -= (scale_x*flag.width - border.width)*flag.flag_options['key_point'][0]
+				with canvas.clip(): # uses last drawing (border)
+					flag.draw(canvas, x, y, scale_x, scale_y, small=False)
+				border.draw(canvas)
+				canvas.stroke(self.map_options['stroke_color'], width=self.map_options['stroke_width']/scale)
+
+		elif id: # no flag, or flag from self.small_flags
+			canvas.fill(self.map_options['map_color'], keep=True) \
+			      .stroke(self.map_options['stroke_color'], width=self.map_options['stroke_width']/scale)
+		else: # no id; just draw stroke
+			canvas.stroke(self.map_options['stroke_color'], width=self.map_options['stroke_width']/scale)
+
+		if id in self.small_flags:
+			small_flags_to_draw.append({'flag': self.small_flags[id], 'border': border})
+
+	def _layout_small_flags(self, small_flags_to_draw:ty.List[dict], scale:float) -> ty.List[tuple]:
+		layout = []
+		if len(small_flags_to_draw) > 0:
+			self._find_centers(small_flags_to_draw, scale)
+			if self.map_options['small_flag_separate']:
+				rects = []
+				sep = self.map_options['small_flag_spacing']
+				for arr in small_flags_to_draw:
+					flag = arr['flag']
+					flag.read()
+					flag.scale = flag.flag_options['small_flag_size']/math.sqrt(flag.width*flag.height)
+					arr['width'], arr['height'] = flag.scale*flag.width, flag.scale*flag.height
+					rw, rh = arr['width'] + sep, arr['height'] + sep
+					rx, ry = arr['x'] - rw/2, arr['y'] - rh/2
+					rects.append(separate.Rectangle(rx, ry, rw, rh))
+
+				if self.print_progress:
+					print('Separating')
+				stepper = separate.Separation(rects)
+				while separate.Rectangle.has_overlaps(stepper.rectangles):
+					stepper.step()
+				if self.print_progress:
+					movement = separate.Rectangle.total_movement(stepper.rectangles)
+					print(f'Total movement: {movement:g} px')
+
+				for i, arr in enumerate(small_flags_to_draw):
+					flag = arr['flag']
+					layout.append((flag, rects[i].midx - arr['width']/2, rects[i].midy - arr['height']/2,
+					               flag.scale))
+
+			else:
+				for arr in small_flags_to_draw:
+					flag = arr['flag']
+					flag.read()
+					flag.scale = flag.flag_options['small_flag_size']/math.sqrt(flag.width*flag.height)
+					x, y = arr['x'] - flag.scale*flag.width/2, arr['y'] - flag.scale*flag.height/2
+					layout.append((flag, x, y, flag.scale))
+
+		return layout
+
+	def _find_centers(self, small_flags_to_draw:ty.List[dict], scale:float):
+		lerp = self.map_options['small_flag_position_lerp']
+		# Poles only need to be accurate to within an output pixel
+		tolerance = 1/scale
+		if lerp > 0:
+			self._find_poles({arr['border'].id: arr['border'].polygons() for arr in small_flags_to_draw},
+			                 scale, self.map_options['processes'])
+
+		for arr in small_flags_to_draw:
+			border = arr['border']
+			pole = self._poles[(border.id, tolerance)] if lerp > 0 else None
+			# Fall back to the bounding box centre if no pole was found
+			arr['x'], arr['y'] = border.get_center(lerp if pole else 0, pole)
+
+	def _find_poles(self, regions:ty.Dict[str, ty.List[ty.List[ty.Tuple[float, float]]]], scale:float,
+	                processes:ty.Optional[int]):
+		# Fill self._poles for any of the regions not already in it
+		tolerance = 1/scale
+		missing = {id: polys for id, polys in regions.items() if (id, tolerance) not in self._poles}
+		if missing:
+			if self.print_progress:
+				print('Finding small flag positions')
+			poles = labels.poles_of_inaccessibility(missing, tolerance, processes)
+			for id, pole in poles.items():
+				if pole is None and self.print_progress:
+					print(f'Warning: couldn\'t find pole of inaccessibility for outline of {id}')
+				self._poles[(id, tolerance)] = pole
+
+	def get_index(self) -> RegionIndex:
+		if self._index is None:
+			import cairopath
+			# Parsing only needs a current point, not an image of the map
+			self._index = _build_index(self.map, cairopath.Canvas(1, 1))
+		# Queries are at output scale, which depends on the current height option
+		return self._index.with_scale(self.map_options['height']/self.map_height)
+
 	def add_flags(self, flags:ty.Dict[str, str], flag_options:dict = {}, *,
 	             small:bool = False, overwrite:bool = True):
 		target = self.small_flags if small else self.flags
@@ -240,18 +562,21 @@ class Flag:
 			if self.print_progress:
 				print('Reading ' + os.path.basename(self.file_path))
 			if self.file_type == '.svg':
+				from cairosvg.parser import Tree as csvg_Tree
+				from cairosvg.surface import SVGSurface as csvg_Surface
 				tree = csvg_Tree(url=self.file_path)
 				surface = csvg_Surface(tree, output=None, dpi=96)
 				self.width, self.height = surface.width, surface.height
 				self.surface = surface.cairo
 			elif self.file_type == '.png':
+				import cairocffi as cairo
 				self.surface = cairo.ImageSurface.create_from_png(self.file_path)
 				self.width, self.height = self.surface.get_width(), self.surface.get_height()
 			else:
 				raise Exception('unsupported flag file type: ' + self.file_type)
 		return self
 
-	def draw(self, canvas:cairopath.Canvas, x:float = 0, y:float = 0,
+	def draw(self, canvas:'cairopath.Canvas', x:float = 0, y:float = 0,
 	         sx:float = 1, sy:ty.Optional[float] = None, *, small:bool = False):
 		if not self.surface:
 			self.read()
@@ -285,12 +610,13 @@ class Border:
 		self.d = d
 		self.vertices = None
 
-	def draw(self, canvas:cairopath.Canvas):
+	def draw(self, canvas:'cairopath.Canvas'):
+		import cairopath
 		obj = cairopath.StringParser(canvas, self.d)
 		obj.draw()
 		self.vertices = obj.vertices
 
-	def parse(self, canvas:cairopath.Canvas):
+	def parse(self, canvas:'cairopath.Canvas'):
 		self.draw(canvas)
 
 		# vertices = [(x,y), (angle,angle), (x,y), ...]
@@ -304,32 +630,29 @@ class Border:
 		self.width = self.max_x - self.min_x
 		self.height = self.max_y - self.min_y
 
-	def get_center(self, small_flag_position_lerp:float = 0):
+	def polygons(self) -> ty.List[ty.List[ty.Tuple[float, float]]]:
+		# Split the vertex list into subpaths
+		polys = [[]]
+		for i, v in enumerate(self.vertices):
+			if i % 2 == 0:
+				if v is not None:
+					polys[-1].append(v)
+			elif v is None:
+				polys.append([])
+		return polys
+
+	def get_center(self, small_flag_position_lerp:float = 0,
+	               pole:ty.Optional[ty.Tuple[float, float]] = None, *, tolerance:float = 1):
 		center_x, center_y = (self.min_x + self.max_x)/2, (self.min_y + self.max_y)/2
 
 		if small_flag_position_lerp > 0:
-			try:
-				polys = [[]]
-				for i, v in enumerate(self.vertices):
-					if i % 2 == 0:
-						polys[-1].append(v)
-					elif v is None:
-						polys.append([])
-				best_point = None
-				best_radius = 0
-				for poly in polys:
-					if len(poly) >= 3:
-						poly_obj = Polygon(poly)
-						point = polylabel(poly_obj)
-						radius = point.distance(poly_obj.exterior)
-						if radius > best_radius:
-							best_point = point
-							best_radius = radius
-				center_x = small_flag_position_lerp*best_point.x + (1 - small_flag_position_lerp)*center_x
-				center_y = small_flag_position_lerp*best_point.y + (1 - small_flag_position_lerp)*center_y
-			except:
-				print(f'Error getting POI for outline of {self.id}:')
-				traceback.print_exc()
+			if pole is None:
+				pole = labels.pole_of_inaccessibility(self.polygons(), tolerance)
+				if pole is None and self.print_progress:
+					print(f'Warning: couldn\'t find pole of inaccessibility for outline of {self.id}')
+			if pole is not None:
+				center_x = small_flag_position_lerp*pole[0] + (1 - small_flag_position_lerp)*center_x
+				center_y = small_flag_position_lerp*pole[1] + (1 - small_flag_position_lerp)*center_y
 
 		return (center_x, center_y)
 
@@ -342,7 +665,9 @@ class ImageMap:
 		self.rel_epsilon = rel_epsilon
 		self.name_function = name_function
 		self.map, self.map_width, self.map_height = _read_map(map_path)
+		import cairopath
 		self._canvas = cairopath.Canvas(round(self.map_width), round(self.map_height))
+		self._index = None
 
 	def list(self, output_path:str):
 		with open(output_path, 'w', encoding='UTF-8') as f:
@@ -355,17 +680,16 @@ class ImageMap:
 					border = Border(id, child.attrib['d'])
 					self._canvas.context.new_path() # reset current point
 					border.parse(self._canvas)
-					poly = []
-					for i, v in enumerate(border.vertices):
-						if i % 2 == 0:
-							poly.append(v)
-						elif v is None:
-							self.poly(f, poly, name)
-							poly = []
-					self.poly(f, poly, name)
+					for poly in border.polygons():
+						self.poly(f, poly, name)
 			
 			f.write('</imagemap>')
 
+	def get_index(self) -> RegionIndex:
+		if self._index is None:
+			self._index = _build_index(self.map, self._canvas)
+		return self._index
+
 	def poly(self, file:ty.TextIO, poly:ty.List[ty.Tuple[float, float]], link:str):
 		epsilon = self.epsilon or math.inf
 		if (self.epsilon or self.rel_epsilon) and len(poly) > 2:
@@ -379,6 +703,7 @@ class ImageMap:
 				epsilon = max(1, min([self.epsilon, (max_x-min_x)*self.rel_epsilon, (max_y-min_y)*self.rel_epsilon]))
 			# Use closed version of path
 			poly = poly + [poly[0]]
+			import rdp
 			poly = rdp.rdp(poly, epsilon=epsilon)
 			del poly[-1]
 
@@ -0,0 +1,151 @@
+""" Spatial index for looking up map regions by point or rectangle """
+
+import copy
+import math
+import typing as ty
+
+Point = ty.Tuple[float, float]
+Polygon = ty.List[Point]
+
+def _bbox(polys:ty.Iterable[Polygon]) -> ty.Tuple[float, float, float, float]:
+	xs = [p[0] for poly in polys for p in poly]
+	ys = [p[1] for poly in polys for p in poly]
+	return (min(xs), min(ys), max(xs), max(ys))
+
+def _winding_number(x:float, y:float, poly:Polygon) -> int:
+	"""Winding number of a closed polygon around the point (x, y)."""
+	wn = 0
+	x1, y1 = poly[-1]
+	for x2, y2 in poly:
+		if y1 <= y:
+			if y2 > y and (x2 - x1)*(y - y1) - (x - x1)*(y2 - y1) > 0:
+				wn += 1
+		elif y2 <= y and (x2 - x1)*(y - y1) - (x - x1)*(y2 - y1) < 0:
+			wn -= 1
+		x1, y1 = x2, y2
+	return wn
+
+def _segment_hits_rect(x1:float, y1:float, x2:float, y2:float,
+                       min_x:float, min_y:float, max_x:float, max_y:float) -> bool:
+	"""Whether a line segment intersects an axis-aligned rectangle (Liang-Barsky clipping)."""
+	t0, t1 = 0., 1.
+	dx, dy = x2 - x1, y2 - y1
+	for p, q in ((-dx, x1 - min_x), (dx, max_x - x1), (-dy, y1 - min_y), (dy, max_y - y1)):
+		if p == 0:
+			if q < 0:
+				return False
+		else:
+			t = q/p
+			if p < 0:
+				if t > t1: return False
+				t0 = max(t0, t)
+			else:
+				if t < t0: return False
+				t1 = min(t1, t)
+	return True
+
+
+class RegionIndex:
+	"""Uniform grid over region bounding boxes, with exact polygon tests for the candidates.
+	Coordinates are stored at map scale; queries are at output scale (map scale times `scale`)
+	unless `map_scale=True` is passed.
+	"""
+	def __init__(self, regions:ty.Iterable[ty.Tuple[str, ty.List[Polygon]]], *,
+	             scale:float = 1, cell_size:ty.Optional[float] = None):
+		self.scale = scale
+		self.ids = []
+		self.bboxes = []
+		self.polygons = []
+		for id, polys in regions:
+			polys = [poly for poly in polys if len(poly) >= 3]
+			if not polys:
+				continue
+			self.ids.append(id)
+			self.bboxes.append(_bbox(polys))
+			self.polygons.append(polys)
+
+		if cell_size is None:
+			# Roughly the average region size, so each region covers only a few cells
+			if self.bboxes:
+				sizes = [max(b[2] - b[0], b[3] - b[1]) for b in self.bboxes]
+				cell_size = sum(sizes)/len(sizes)
+			cell_size = cell_size or 1
+		self.cell_size = cell_size
+
+		self.grid = {}
+		for i, bbox in enumerate(self.bboxes):
+			for cell in self._cells(*bbox):
+				self.grid.setdefault(cell, []).append(i)
+		# Range of filled cells, to limit rectangle queries to
+		if self.grid:
+			self.extent = (min(c[0] for c in self.grid), min(c[1] for c in self.grid),
+			               max(c[0] for c in self.grid), max(c[1] for c in self.grid))
+		else:
+			self.extent = None
+
+	def with_scale(self, scale:float) -> 'RegionIndex':
+		"""Return a copy with a different output scale, sharing the indexed regions."""
+		index = copy.copy(self)
+		index.scale = scale
+		return index
+
+	def _cells(self, min_x:float, min_y:float, max_x:float, max_y:float, *,
+	           clamp:bool = False) -> ty.Iterator[ty.Tuple[int, int]]:
+		x0, x1 = math.floor(min_x/self.cell_size), math.floor(max_x/self.cell_size)
+		y0, y1 = math.floor(min_y/self.cell_size), math.floor(max_y/self.cell_size)
+		if clamp:
+			if self.extent is None:
+				return
+			x0, y0 = max(x0, self.extent[0]), max(y0, self.extent[1])
+			x1, y1 = min(x1, self.extent[2]), min(y1, self.extent[3])
+		for cx in range(x0, x1 + 1):
+			for cy in range(y0, y1 + 1):
+				yield (cx, cy)
+
+	def _contains(self, i:int, x:float, y:float) -> bool:
+		# Nonzero fill rule, as used by Cairo when filling the border path
+		return sum(_winding_number(x, y, poly) for poly in self.polygons[i]) != 0
+
+	def region_at(self, x:float, y:float, *, map_scale:bool = False) -> ty.Optional[str]:
+		"""Return the ID of the region containing the point, or None.
+		If regions overlap, the one drawn last (i.e. on top) is returned.
+		"""
+		if not map_scale:
+			x, y = x/self.scale, y/self.scale
+		cell = (math.floor(x/self.cell_size), math.floor(y/self.cell_size))
+		for i in reversed(self.grid.get(cell, [])):
+			min_x, min_y, max_x, max_y = self.bboxes[i]
+			if min_x <= x <= max_x and min_y <= y <= max_y and self._contains(i, x, y):
+				return self.ids[i]
+		return None
+
+	def regions_in(self, x:float, y:float, width:float, height:float, *,
+	               map_scale:bool = False) -> ty.List[str]:
+		"""Return the IDs of all regions intersecting the rectangle, in drawing order."""
+		if not map_scale:
+			x, y, width, height = x/self.scale, y/self.scale, width/self.scale, height/self.scale
+		min_x, max_x = sorted((x, x + width))
+		min_y, max_y = sorted((y, y + height))
+
+		candidates = set()
+		for cell in self._cells(min_x, min_y, max_x, max_y, clamp=True):
+			candidates.update(self.grid.get(cell, []))
+
+		found = []
+		for i in sorted(candidates):
+			b = self.bboxes[i]
+			if b[0] > max_x or b[2] < min_x or b[1] > max_y or b[3] < min_y:
+				continue
+			if self._intersects(i, min_x, min_y, max_x, max_y):
+				found.append(self.ids[i])
+		return found
+
+	def _intersects(self, i:int, min_x:float, min_y:float, max_x:float, max_y:float) -> bool:
+		# Either an edge crosses (or lies in) the rectangle, or the rectangle lies inside the region
+		for poly in self.polygons[i]:
+			x1, y1 = poly[-1]
+			for x2, y2 in poly:
+				if _segment_hits_rect(x1, y1, x2, y2, min_x, min_y, max_x, max_y):
+					return True
+				x1, y1 = x2, y2
+		return self._contains(i, min_x, min_y)
@@ -0,0 +1,61 @@
+""" Find label points (poles of inaccessibility) for placing small flags """
+
+import itertools
+import typing as ty
+
+Point = ty.Tuple[float, float]
+
+def pole_of_inaccessibility(polys:ty.List[ty.List[Point]], tolerance:float = 1) -> ty.Optional[Point]:
+	"""Find the pole of inaccessibility of the largest subpath of a region.
+	Returns the point furthest from its subpath's outline, to within `tolerance`,
+	or None if none of the subpaths is a valid polygon.
+	"""
+	try: # shapely 1.7+
+		from shapely.ops import polylabel
+	except ImportError: # shapely 1.6
+		from shapely.algorithms.polylabel import polylabel
+	from shapely.geometry import Polygon
+
+	# A subpath's inscribed circle can't be larger than half the smaller side
+	# of its bounding box, so try the most promising subpaths first
+	candidates = []
+	for poly in polys:
+		if len(poly) >= 3:
+			xs, ys = [p[0] for p in poly], [p[1] for p in poly]
+			bound = min(max(xs) - min(xs), max(ys) - min(ys))/2
+			candidates.append((bound, poly))
+	candidates.sort(key=lambda c: c[0], reverse=True)
+
+	best_point = None
+	best_radius = 0
+	for bound, poly in candidates:
+		if bound <= best_radius:
+			break
+		try:
+			poly_obj = Polygon(poly)
+			point = polylabel(poly_obj, tolerance)
+			radius = point.distance(poly_obj.exterior)
+		except Exception: # invalid outline; the error type depends on the shapely version
+			continue
+		if radius > best_radius:
+			best_point = point
+			best_radius = radius
+
+	return (best_point.x, best_point.y) if best_point is not None else None
+
+def poles_of_inaccessibility(regions:ty.Mapping[str, ty.List[ty.List[Point]]], tolerance:float = 1,
+                             processes:ty.Optional[int] = None) -> ty.Dict[str, ty.Optional[Point]]:
+	"""Find the poles of inaccessibility for a set of regions, mapping region IDs to subpaths.
+	If `processes` is more than 1, the regions are divided over that many worker processes.
+	"""
+	ids = list(regions.keys())
+	polys = [regions[id] for id in ids]
+	if processes and processes > 1 and len(ids) > 1:
+		import concurrent.futures
+		with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+			chunksize = max(1, len(ids)//(4*processes))
+			poles = list(executor.map(pole_of_inaccessibility, polys, itertools.repeat(tolerance),
+			                          chunksize=chunksize))
+	else:
+		poles = [pole_of_inaccessibility(p, tolerance) for p in polys]
+	return dict(zip(ids, poles))
@@ -0,0 +1,86 @@
+""" Incremental PNG encoder for writing Cairo image surfaces one band at a time """
+
+import struct
+import sys
+import typing as ty
+import zlib
+
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+class PNGWriter:
+	"""Write an RGBA PNG file from consecutive horizontal bands of image rows.
+	Only the compressor state and the current band are kept in memory.
+	"""
+	def __init__(self, path:str, width:int, height:int, *, compression:int = 6):
+		self.width = width
+		self.height = height
+		self.rows_written = 0
+		self.file = open(path, 'wb')
+		self.file.write(SIGNATURE)
+		# 8 bits per channel, colour type 6 (RGBA), no interlacing
+		self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+		self.compressor = zlib.compressobj(compression)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.file.close()
+
+	def _chunk(self, chunk_type:bytes, data:bytes):
+		self.file.write(struct.pack('>I', len(data)))
+		self.file.write(chunk_type)
+		self.file.write(data)
+		self.file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+	def write_rows(self, data:bytes, rows:int):
+		"""Add `rows` rows of filtered scanline data (each prefixed by its filter type byte)."""
+		if self.rows_written + rows > self.height:
+			raise ValueError(f'too many rows for image height {self.height}')
+		self.rows_written += rows
+		compressed = self.compressor.compress(data)
+		if compressed:
+			self._chunk(b'IDAT', compressed)
+
+	def write_surface(self, surface:ty.Any):
+		"""Add all rows of a Cairo ARGB32 image surface with the same width as the image."""
+		import numpy as np
+		surface.flush()
+		width, height, stride = surface.get_width(), surface.get_height(), surface.get_stride()
+		if width != self.width:
+			raise ValueError(f'surface width {width} doesn\'t match image width {self.width}')
+
+		data = np.frombuffer(surface.get_data(), dtype=np.uint8).reshape(height, stride)
+		pixels = data[:, :4*width].reshape(height, width, 4).astype(np.uint32)
+		# ARGB32 pixels are stored in native byte order
+		if sys.byteorder == 'little':
+			b, g, r, a = pixels[..., 0], pixels[..., 1], pixels[..., 2], pixels[..., 3]
+		else:
+			a, r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2], pixels[..., 3]
+
+		# Undo premultiplied alpha, rounding the same way as Cairo's own PNG export
+		rgba = np.zeros((height, width, 4), dtype=np.uint8)
+		opaque = a > 0
+		safe_a = np.where(opaque, a, 1)
+		for i, channel in enumerate((r, g, b)):
+			rgba[..., i] = np.where(opaque, (channel*255 + safe_a//2)//safe_a, 0)
+		rgba[..., 3] = a
+
+		# Sub filter: store each byte as the difference from the same channel of the previous pixel
+		rgba = rgba.reshape(height, 4*width)
+		rows = np.empty((height, 4*width + 1), dtype=np.uint8)
+		rows[:, 0] = 1
+		rows[:, 1:5] = rgba[:, :4]
+		rows[:, 5:] = rgba[:, 4:] - rgba[:, :-4]
+		self.write_rows(rows.tobytes(), height)
+
+	def close(self):
+		if self.rows_written != self.height:
+			self.file.close()
+			raise ValueError(f'{self.rows_written} rows written for image height {self.height}')
+		self._chunk(b'IDAT', self.compressor.flush())
+		self._chunk(b'IEND', b'')
+		self.file.close()